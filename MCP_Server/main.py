@@ -1,37 +1,72 @@
-﻿from dataclasses import dataclass
-from datetime import datetime, timezone
-import json
+﻿import asyncio
+import atexit
+from dataclasses import dataclass
+from functools import lru_cache
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 import queue
+import re
+import aioserial
+import orjson
 import serial
-import threading
 import time
-from typing import Optional, Callable, Any, Dict, List
+from typing import Optional, Callable, Any, Deque, Dict, List, Tuple
 from collections import deque
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 from pydantic import BaseModel
 from fastmcp import FastMCP
 
+from timefmt import fmt_ts
+
+try:
+    import uvloop
+except ImportError: # uvloop does not support Windows; fall back to the default asyncio loop
+    uvloop = None
+
 # --- Basic Setup ---
 logger = logging.getLogger("devaiot-mcp")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get("MCP_LOG_LEVEL", "DEBUG").upper()) # INFO or above also skips ACK lines
 PORT = 'COM9'  # Change to your COM port if different
-LOG_DEQUE = deque(maxlen=300)
+SERIAL_RX_BUFFER = 64 * 1024
+STATE_MAX_AGE_NS = 5_000_000_000 # Five firmware report intervals (REPORT_INTERVAL = 1000 ms)
+LOG_DEQUE: Deque[bytes] = deque(maxlen=300) # JSON-encoded log lines, ready to splice into /logs
+LOG_QUEUE_SIZE = 100_000
 
 # --- Logging Configuration ---
+class DroppingQueueHandler(QueueHandler):
+    """Drops records when the queue is full so a stalled disk never blocks the caller."""
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+class TsFormatter(logging.Formatter):
+    """Uses the ``ts`` passed via ``extra`` when present, otherwise formats the record time."""
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "ts"):
+            record.ts = fmt_ts(int(record.created * 1_000_000_000))
+        return super().format(record)
+
 def configure_logging() -> None:
-    formatter = logging.Formatter("%(asctime)sZ %(levelname)s %(message)s")
+    formatter = TsFormatter("%(ts)s %(levelname)s %(message)s")
     
     # Configure file logging
     log_file = Path(__file__).parent / "mcp_server.log"
     file_handler = RotatingFileHandler(log_file, maxBytes=1024*1024*5, backupCount=2) # 5MB per file, 2 backups
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+
+    # Records are formatted and written by a background listener thread
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
     # Silence other loggers
     logging.getLogger("fastmcp").setLevel(logging.WARNING)
@@ -39,24 +74,16 @@ def configure_logging() -> None:
 configure_logging()
 
 # --- Data Structures ---
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Vec3:
     x: float
     y: float
     z: float
 
-@dataclass(frozen=True)
-class ApdsColor:
-    r: int
-    g: int
-    b: int
-    c: int
-
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SensorPacket:
-    timestamp: datetime
+    ts_ns: int
     raw_line: str
-    raw_json: Optional[Dict[str, Any]] = None
     kind: str = "text"
     temp_c: Optional[float] = None
     humidity_rh: Optional[float] = None
@@ -70,100 +97,139 @@ class SensorPacket:
 
 # --- Arduino Communication ---
 
+@lru_cache(maxsize=1024)
+def _intern_vec3(x: float, y: float, z: float) -> Vec3:
+    """Returns a shared Vec3 for repeated readings (e.g. a stationary board)."""
+    return Vec3(x, y, z)
+
 def _as_vec3(val: Any) -> Optional[Vec3]:
     try:
         if isinstance(val, Vec3): return val
         if isinstance(val, (list, tuple)) and len(val) == 3:
-            return Vec3(float(val[0]), float(val[1]), float(val[2]))
+            return _intern_vec3(float(val[0]), float(val[1]), float(val[2]))
     except Exception:
         return None
     return None
 
-def _parse_nonjson_line(ts: datetime, line: str) -> Optional[SensorPacket]:
-    if line.startswith("ACK="):
-        payload = line[4:]
+_NONJSON_RE = re.compile(r"ACK=(?P<ack>.*)|ERR=(?P<err>.*)|(?P<dist>(?i:distance to target))", re.DOTALL)
+_TARGET_RE = re.compile(r"TARGET_SET,([-+\d.eE]+),([-+\d.eE]+),([-+\d.eE]+)")
+
+def _parse_nonjson_line(ts_ns: int, line: str) -> Optional[SensorPacket]:
+    m = _NONJSON_RE.match(line)
+    if m is None:
+        return SensorPacket(ts_ns=ts_ns, raw_line=line, kind="text", info=line)
+    payload = m.group("ack")
+    if payload is not None:
         coords: Optional[Dict[str, float]] = None
-        parts = payload.split(",")
-        if parts[0] == "TARGET_SET" and len(parts) == 4:
+        t = _TARGET_RE.fullmatch(payload)
+        if t:
             try:
-                coords = {"x": float(parts[1]), "y": float(parts[2]), "z": float(parts[3])}
-            except Exception:
+                coords = {"x": float(t[1]), "y": float(t[2]), "z": float(t[3])}
+            except ValueError:
                 coords = None
-        return SensorPacket(timestamp=ts, raw_line=line, kind="ack", ack=payload, position=coords, info=payload)
-    if line.startswith("ERR="):
-        return SensorPacket(timestamp=ts, raw_line=line, kind="err", error=line[4:], info=line[4:])
-    if line.lower().startswith("distance to target"):
-        return None
-    return SensorPacket(timestamp=ts, raw_line=line, kind="text", info=line)
-
-def parse_packet(line: str) -> Optional[SensorPacket]:
-    if not line: return None
-    ts = datetime.now(timezone.utc)
-    try:
-        obj = json.loads(line)
-        if not isinstance(obj, dict):
-            return SensorPacket(timestamp=ts, raw_line=line, raw_json=obj, kind="json")
-        
-        position = obj.get("position") if isinstance(obj.get("position"), dict) else None
-        
-        return SensorPacket(
-            timestamp=ts, raw_line=line, raw_json=obj, kind="json",
-            temp_c=obj.get("temp_c"),
-            humidity_rh=obj.get("humidity_rh"),
-            position=position,
-            distance_to_target=obj.get("distance_to_target"),
-            acc_g=_as_vec3(obj.get("acc_g")),
-            gyro_dps=_as_vec3(obj.get("gyro_dps")),
-        )
-    except Exception:
-        return _parse_nonjson_line(ts, line)
+        return SensorPacket(ts_ns=ts_ns, raw_line=line, kind="ack", ack=payload, position=coords, info=payload)
+    error = m.group("err")
+    if error is not None:
+        return SensorPacket(ts_ns=ts_ns, raw_line=line, kind="err", error=error, info=error)
+    return None
 
-def clear_queue(q: queue.Queue):
-    while not q.empty():
+_loads = orjson.loads
+_time_ns = time.time_ns
+
+def parse_packet(raw: bytes) -> Optional[SensorPacket]:
+    raw = raw.strip()
+    if not raw: return None
+    ts_ns = _time_ns()
+    line = raw.decode(errors="replace")
+    # Only lines opening with '{' can be sensor JSON; everything else goes straight
+    # to the text parser instead of raising a decode error first.
+    if raw[0] == 0x7B:
         try:
-            q.get_nowait()
-            q.task_done()
-        except queue.Empty:
-            break
+            obj = _loads(raw)
+            position = obj.get("position") if isinstance(obj.get("position"), dict) else None
+            
+            return SensorPacket(
+                ts_ns=ts_ns, raw_line=line, kind="json",
+                temp_c=obj.get("temp_c"),
+                humidity_rh=obj.get("humidity_rh"),
+                position=position,
+                distance_to_target=obj.get("distance_to_target"),
+                acc_g=_as_vec3(obj.get("acc_g")),
+                gyro_dps=_as_vec3(obj.get("gyro_dps")),
+            )
+        except Exception:
+            pass
+    return _parse_nonjson_line(ts_ns, line)
 
 class Nano33SenseRev2:
     def __init__(self, port: str, baud: int = 115200, on_packet: Optional[Callable[[SensorPacket], None]] = None):
-        self.ser = serial.Serial(port, baud, timeout=1)
+        self.ser = aioserial.AioSerial(port=port, baudrate=baud, timeout=1)
+        try:
+            # Give the driver room to absorb a stalled reader (GC pause, slow log write)
+            self.ser.set_buffer_size(rx_size=SERIAL_RX_BUFFER, tx_size=4096)
+        except AttributeError: # Only the Windows backend exposes driver buffer sizes
+            pass
         self.on_packet = on_packet
         self._running = True
-        self._latest_sensor = queue.Queue(maxsize=1)
-        self._thread = threading.Thread(target=self._read_loop, daemon=True)
-        self._thread.start()
+        self._latest_sensor: Optional[SensorPacket] = None
+        self._latest_sensor_ev = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._buf = bytearray()
+
+    def start(self) -> asyncio.Task:
+        """Schedules the serial read loop on the running event loop."""
+        self._task = asyncio.create_task(self._read_loop())
+        return self._task
 
     def _send(self, msg: str):
         if not msg.endswith("\n"): msg += "\n"
         self.ser.write(msg.encode("utf-8"))
 
-    def _read_loop(self):
+    async def _read_loop(self):
+        # Bind hot-path lookups once; the loop body runs for every chunk the board sends
+        ser = self.ser
+        read_async = ser.read_async
+        parse = parse_packet
+        on_packet = self.on_packet
+        latest_set = self._latest_sensor_ev.set
+        buf = self._buf
+        find = buf.find
         while self._running:
             try:
-                raw = self.ser.readline()
-                if not raw: continue
-                line = raw.decode(errors="replace").strip()
-                if not line: continue
+                # Drain everything the driver has buffered in one read, then split lines locally
+                chunk = await read_async(ser.in_waiting or 1)
+                if not chunk: continue
+                buf += chunk
                 
-                pkt = parse_packet(line)
-                if pkt:
-                    if self.on_packet: self.on_packet(pkt)
-                    if pkt.kind == "json":
-                        clear_queue(self._latest_sensor)
-                        self._latest_sensor.put(pkt, block=False)
+                idx = find(b"\n")
+                while idx != -1:
+                    raw = bytes(buf[:idx])
+                    del buf[:idx + 1]
+                    pkt = parse(raw)
+                    if pkt:
+                        if on_packet: on_packet(pkt)
+                        if pkt.kind == "json":
+                            self._latest_sensor = pkt
+                            latest_set()
+                    idx = find(b"\n")
             except serial.SerialException as e:
                 logger.error(f"Serial error: {e}")
-                time.sleep(5) # Avoid spamming logs on disconnect
+                await asyncio.sleep(5) # Avoid spamming logs on disconnect
             except Exception as e:
                 logger.error(f"Error in read loop: {e}")
 
-    def get_state(self) -> Optional[SensorPacket]:
-        try:
-            return self._latest_sensor.get(timeout=2)
-        except queue.Empty:
+    async def get_state(self) -> Optional[SensorPacket]:
+        """Waits up to 2s for a fresh packet, falling back to the last one seen unless it is stale."""
+        if not self._latest_sensor_ev.is_set():
+            try:
+                await asyncio.wait_for(self._latest_sensor_ev.wait(), timeout=2)
+            except asyncio.TimeoutError:
+                pass
+        self._latest_sensor_ev.clear()
+        pkt = self._latest_sensor
+        if pkt is None or time.time_ns() - pkt.ts_ns > STATE_MAX_AGE_NS:
             return None
+        return pkt
 
     def goto(self, x: float, y: float, z: float):
         self._send(f"GOTO={x},{y},{z}")
@@ -177,11 +243,28 @@ class Nano33SenseRev2:
 
     def close(self):
         self._running = False
+        if self._task: self._task.cancel()
         if self.ser and self.ser.is_open:
             self.ser.close()
 
 # --- Log Processing ---
+_LOG_ETAG_PREFIX = format(time.time_ns(), "x")
+_log_seq = 0
+_log_cache: Optional[Tuple[int, bytes]] = None
+ACK_DEDUP_NS = 1_000_000_000 # Identical ACKs within this window reach the UI deque once
+_last_ack: Tuple[Optional[str], int] = (None, 0)
+
+def append_log_line(line: str) -> None:
+    """Adds a line to the UI log deque and bumps the sequence number used by /logs."""
+    global _log_seq
+    LOG_DEQUE.append(orjson.dumps(line))
+    _log_seq += 1
+
 def show(p: SensorPacket) -> None:
+    global _last_ack
+    if p.kind == 'ack' and not logger.isEnabledFor(logging.DEBUG):
+        return # ACKs are only ever logged at DEBUG
+
     log_level = "INFO"
     message = ""
 
@@ -215,14 +298,21 @@ def show(p: SensorPacket) -> None:
     if not message or not message.strip():
         return
 
-    # Log to console
-    if log_level == "ERROR": logger.error(message)
-    elif log_level == "DEBUG": logger.debug(message)
-    else: logger.info(message)
+    # Format the timestamp once and share it between the log file and the UI deque
+    ts_str = fmt_ts(p.ts_ns)
+    extra = {"ts": ts_str}
+    if log_level == "ERROR": logger.error(message, extra=extra)
+    elif log_level == "DEBUG": logger.debug(message, extra=extra)
+    else: logger.info(message, extra=extra)
     
-    # Add to UI log deque
-    log_line = f"{p.timestamp.isoformat().replace('+00:00', 'Z')} {log_level} {message}"
-    LOG_DEQUE.append(log_line)
+    # Add to UI log deque, collapsing bursts of the same ACK
+    if p.kind == 'ack':
+        last_ack, last_ns = _last_ack
+        if p.ack == last_ack and p.ts_ns - last_ns < ACK_DEDUP_NS:
+            return
+        _last_ack = (p.ack, p.ts_ns)
+    log_line = f"{ts_str} {log_level} {message}"
+    append_log_line(log_line)
 
 # --- FastAPI Web Server ---
 app = FastAPI()
@@ -231,9 +321,31 @@ app.add_middleware(
     allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
 
+def _logs_body(seq: int, lines) -> bytes:
+    return b'{"seq":%d,"lines":[' % seq + b",".join(lines) + b"]}"
+
 @app.get("/logs")
-def get_logs(limit: int = 300):
-    return {"lines": list(LOG_DEQUE)}
+async def get_logs(request: Request, limit: int = 300, since: Optional[int] = None):
+    """Returns the last `limit` log lines, or only those logged after sequence `since`."""
+    global _log_cache
+    seq = _log_seq
+    etag = f'"{_LOG_ETAG_PREFIX}-{seq}-{limit}-{since}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    count = limit
+    if since is not None and since <= seq:
+        # Sequence numbers are consecutive, so the newest `seq - since` lines are the new ones
+        count = min(count, seq - since)
+    # Otherwise a `since` beyond our newest line comes from before a restart: send the full tail
+    if count < len(LOG_DEQUE):
+        body = _logs_body(seq, list(LOG_DEQUE)[-count:] if count > 0 else [])
+        return Response(body, media_type="application/json", headers={"ETag": etag})
+    # The full body is built once per new log line and reused until the next append
+    cached = _log_cache
+    if cached is None or cached[0] != seq:
+        cached = (seq, _logs_body(seq, LOG_DEQUE))
+        _log_cache = cached
+    return Response(cached[1], media_type="application/json", headers={"ETag": etag})
 
 class GotoCoords(BaseModel):
     x: float
@@ -245,8 +357,7 @@ def set_goto_target(x: float, y: float, z: float) -> str:
     board.goto(x, y, z)
     log_message = f"GOTO target set to: x={x}, y={y}, z={z}."
     logger.info(log_message)
-    # log_line = f"{datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')} INFO {log_message}"
-    # LOG_DEQUE.append(log_line)
+    # append_log_line(f"{fmt_ts(time.time_ns())} INFO {log_message}")
     return f"GOTO target set to: x={x}, y={y}, z={z}."
 
 @app.post("/mcp/goto_target")
@@ -264,25 +375,25 @@ def goto_target(x: float, y: float, z: float) -> str:
     return set_goto_target(x, y, z)
 
 @ArduinoMCP.tool
-def get_current_temperature():
+async def get_current_temperature():
     """Gets the most recent temperature from the Arduino"""
-    state = board.get_state()
+    state = await board.get_state()
     if state and state.temp_c is not None:
         return f"{state.temp_c:.2f} degrees celsius"
     return "Could not retrieve temperature."
 
 @ArduinoMCP.tool
-def get_current_humidity():
+async def get_current_humidity():
     """Gets the most recent humidity from the Arduino"""
-    state = board.get_state()
+    state = await board.get_state()
     if state and state.humidity_rh is not None:
         return f"{state.humidity_rh:.2f}%"
     return "Could not retrieve humidity."
 
 @ArduinoMCP.tool
-def get_current_position():
+async def get_current_position():
     """Gets the most recent position from the Arduino"""
-    state = board.get_state()
+    state = await board.get_state()
     if state and state.position:
         pos = state.position
         return f"x={pos['x']:.2f}, y={pos['y']:.2f}, z={pos['z']:.2f}"
@@ -298,7 +409,8 @@ def read_logs(limit: int = 100) -> list: # Change return type hint to list
     logs = list(LOG_DEQUE)[-limit:]
     log_entries = []
     
-    for log_line in logs:
+    for encoded in logs:
+        log_line = orjson.loads(encoded)
         parts = log_line.split(" ", 2)
         if len(parts) == 3:
             log_entries.append({
@@ -310,7 +422,7 @@ def read_logs(limit: int = 100) -> list: # Change return type hint to list
             # Fallback for lines that don't match the format 
             # so the LLM doesn't miss "Raw" errors
             log_entries.append({
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "timestamp": fmt_ts(time.time_ns()),
                 "level": "RAW",
                 "message": log_line
             })
@@ -318,29 +430,32 @@ def read_logs(limit: int = 100) -> list: # Change return type hint to list
     return log_entries # FastMCP will convert this to JSON for you
 
 # --- Main Execution ---
-if __name__ == "__main__":
-    uvicorn_thread = threading.Thread(
-        target=uvicorn.run,
-        args=(app,),
-        kwargs={"host": "0.0.0.0", "port": 8100, "log_level": "warning"},
-        daemon=True,
-    )
-    uvicorn_thread.start()
+async def main() -> None:
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=8100, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    board.start()
     logger.info("Web server started. Log endpoint available at http://localhost:8100/logs")
 
     try:
         logger.info("Initializing connection with Arduino...")
-        board.red_LED(); time.sleep(0.5)
-        board.yellow_LED(); time.sleep(0.5)
+        board.red_LED(); await asyncio.sleep(0.5)
+        board.yellow_LED(); await asyncio.sleep(0.5)
         board.off()
         logger.info("Arduino Connected. Starting MCP Server.")
-        
-        ArduinoMCP.run()
 
+        await ArduinoMCP.run_async()
+    finally:
+        server.should_exit = True
+        await server_task
+
+if __name__ == "__main__":
+    try:
+        # uvicorn, the serial reader and the MCP server all share this one loop
+        (uvloop.run if uvloop else asyncio.run)(main())
     except (KeyboardInterrupt, serial.SerialException) as e:
         if isinstance(e, serial.SerialException):
             logger.error(f"Could not connect to Arduino on {PORT}. Please check the port and connection.")
         else:
             logger.info("Shutting down...")
     finally:
-        board.close()
\ No newline at end of file
+        board.close()
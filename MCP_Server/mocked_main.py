@@ -1,79 +1,130 @@
-﻿import json
+﻿import asyncio
+from contextlib import asynccontextmanager
+import orjson
 import random
 import time
 from datetime import datetime, timezone
 from fastmcp import FastMCP
-import threading
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import uvicorn
 from collections import deque
+from itertools import islice
+from typing import Deque, List, Optional, Tuple
 from pydantic import BaseModel
 
+from timefmt import fmt_ts
+
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-# We will store logs in a deque and expose them via an API endpoint
-LOG_DEQUE = deque(maxlen=300)
+# Callers only enqueue records; a listener thread formats and writes them to the console
+_log_queue = queue.SimpleQueue()
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logging.root.setLevel(logging.INFO)
+logging.root.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _console_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+# We will store logs in a deque and expose them via an API endpoint.
+# Entries are (sequence number, JSON-encoded line) so /logs can splice lines straight
+# into its body and clients can ask for only what is newer than their last poll.
+LOG_DEQUE: Deque[Tuple[int, bytes]] = deque(maxlen=300)
+_log_seq = 0
+
+def append_log_line(line: str) -> None:
+    """Encodes a log line once, on append, and tags it with the next sequence number."""
+    global _log_seq
+    _log_seq += 1
+    LOG_DEQUE.append((_log_seq, orjson.dumps(line)))
 
 # --- Mocked Data Generation ---
 
 # Store the target location for the GOTO function
+# Positions are [x, y, z] lists so each step is one pass over the three axes
 target_location = None
-current_position = {"x": 0.0, "y": 0.0, "z": 0.0}
+current_position = [0.0, 0.0, 0.0]
+# Set once a target exists; the data generation loop sleeps on it until then
+TARGET_EVENT = asyncio.Event()
+
+# Readings younger than this are reused, so back-to-back tool calls and the
+# background loop share one simulation step instead of each advancing it
+SENSOR_DATA_TTL = 0.1
+_last_reading = {"t": 0.0, "data": None}
+
+# Private generator; draws are scaled inline rather than through random.uniform()
+_rand = random.Random().random
 
 def generate_sensor_data():
     """Generates a dictionary of random sensor data."""
     global current_position
     
+    now = time.monotonic()
+    if _last_reading["data"] is not None and now - _last_reading["t"] < SENSOR_DATA_TTL:
+        return _last_reading["data"]
+
     if target_location:
-        # Move current position towards target
-        for axis in ["x", "y", "z"]:
-            if abs(current_position[axis] - target_location[axis]) > 0.1:
-                if current_position[axis] < target_location[axis]:
-                    current_position[axis] += 1
-                elif current_position[axis] > target_location[axis]:
-                    current_position[axis] -= 1
-            # Add some random jitter
-            # current_position[axis] += random.uniform(-0.5, 0.5)
-
-
-    return {
+        # Move current position towards target, one unit per axis
+        current_position = [
+            c + 1 if t - c > 0.1 else c - 1 if c - t > 0.1 else c
+            for c, t in zip(current_position, target_location)
+        ]
+        # Add some random jitter
+        # current_position = [c - 0.5 + _rand() for c in current_position]
+
+    # Values stay unrounded; each caller formats them once for its own output
+    x, y, z = current_position
+    data = {
         "timestamp": datetime.now(timezone.utc).isoformat(),
-        "position": {
-            "x": round(current_position["x"], 2),
-            "y": round(current_position["y"], 2),
-            "z": round(current_position["z"], 2)
-        },
-        "temperature": round(random.uniform(20.0, 30.0), 2),
-        "humidity": round(random.uniform(40.0, 60.0), 2)
+        "position": {"x": x, "y": y, "z": z},
+        "temperature": 20.0 + 10.0 * _rand(),
+        "humidity": 40.0 + 20.0 * _rand()
     }
+    _last_reading["t"] = now
+    _last_reading["data"] = data
+    return data
 
 # --- MCP Server Setup ---
 
 MockedArduinoMCP = FastMCP('Mocked Arduino Server')
 
 
-def goto_target(x: float, y: float, z: float):
-    """Sets the target coordinates for the mocked device."""
+GOTO_MSG_FMT = "GOTO target set to: x={}, y={}, z={}."
+
+def set_goto_target(x: float, y: float, z: float) -> str:
+    """Sets the mocked device's target and logs it."""
     global target_location
-    target_location = {"x": x, "y": y, "z": z}
-    # current_position = {"x": 0.0, "y": 0.0, "z": 0.0}
-    log_message = f"GOTO target set to: x={x}, y={y}, z={z}."
+    target_location = [x, y, z]
+    TARGET_EVENT.set()
+    # current_position = [0.0, 0.0, 0.0]
+    log_message = GOTO_MSG_FMT.format(x, y, z)
     logging.info(log_message)
-    log_line = f"{datetime.now(timezone.utc).isoformat()}Z INFO {log_message}"
-    LOG_DEQUE.append(log_line)
-    return f"GOTO target set to: x={x}, y={y}, z={z}."
+    append_log_line(f"{fmt_ts(time.time_ns())} INFO {log_message}")
+    return log_message
+
+def goto_target(x: float, y: float, z: float):
+    """Sets the target coordinates for the mocked device."""
+    return set_goto_target(x, y, z)
 
 @MockedArduinoMCP.tool
 def get_sensor_data():
     """Returns the latest generated sensor data."""
-    return json.dumps(generate_sensor_data())
+    data = generate_sensor_data()
+    pos = data["position"]
+    return orjson.dumps({
+        "timestamp": data["timestamp"],
+        "position": {"x": round(pos["x"], 2), "y": round(pos["y"], 2), "z": round(pos["z"], 2)},
+        "temperature": round(data["temperature"], 2),
+        "humidity": round(data["humidity"], 2)
+    }).decode()
 
 @MockedArduinoMCP.tool
 def get_current_temperature():
     """Gets the most recent temperature from the mocked device."""
-    return f"{generate_sensor_data()['temperature']} degrees celsius"
+    return f"{generate_sensor_data()['temperature']:.2f} degrees celsius"
 
 @MockedArduinoMCP.tool
 def get_current_position():
@@ -82,40 +133,96 @@ def get_current_position():
     return f"x={pos['x']:.2f}, y={pos['y']:.2f}, z={pos['z']:.2f}"
 
 
-def data_generation_loop():
+POSITION_MSG_FMT = "POSITION x={x:.2f}, y={y:.2f}, z={z:.2f} | TEMP={t:.1f}C | HUMIDITY={h:.1f}% |"
+
+async def data_generation_loop():
     """A loop to continuously generate data in the background and log it."""
+    await TARGET_EVENT.wait() # No wake-ups at all until a GOTO target is set
     while True:
         if target_location:
             sensor_data = generate_sensor_data()
             pos = sensor_data["position"]
-            temp = sensor_data["temperature"]
-            humidity = sensor_data["humidity"]
-            
-            message = f"POSITION x={pos['x']:.2f}, y={pos['y']:.2f}, z={pos['z']:.2f} | TEMP={temp:.1f}C | HUMIDITY={humidity:.1f}% |"
+            message = POSITION_MSG_FMT.format_map({
+                "x": pos["x"], "y": pos["y"], "z": pos["z"],
+                "t": sensor_data["temperature"], "h": sensor_data["humidity"],
+            })
             
             # Use a timestamp format compatible with the frontend parser
-            ts = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+            ts = fmt_ts(time.time_ns())
 
             log_line = f"{ts} INFO {message}"
-            LOG_DEQUE.append(log_line)
+            append_log_line(log_line)
             logging.info(message)
-        time.sleep(2.5)
+        await asyncio.sleep(2.5)
 
-# --- Web Server Setup ---
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Generate data on the server's own event loop rather than in a separate thread
+    task = asyncio.create_task(data_generation_loop())
+    yield
+    task.cancel()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
+# --- Web Server Setup ---
+_CORS_ALLOW_ORIGIN = (b"access-control-allow-origin", b"*")
+_CORS_PREFLIGHT_HEADERS = [
+    _CORS_ALLOW_ORIGIN,
+    (b"access-control-allow-methods", b"*"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-max-age", b"600"),
+    (b"content-length", b"0"),
+]
+
+class WildcardCORSMiddleware:
+    """Allows any origin: answers preflights with fixed headers and tags every response."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS" and any(k == b"access-control-request-method" for k, _ in scope["headers"]):
+            await send({"type": "http.response.start", "status": 200, "headers": _CORS_PREFLIGHT_HEADERS})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), _CORS_ALLOW_ORIGIN]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(WildcardCORSMiddleware)
+
+LOG_STREAM_BATCH = 64 # Lines per chunk written by the streaming /logs response
+
+async def _stream_logs(seq: int, entries: List[Tuple[int, bytes]]):
+    """Yields the /logs JSON body oldest-first, joining at most LOG_STREAM_BATCH lines at a time.
+
+    `entries` is the newest-first snapshot taken by get_logs; only one batch of
+    lines is ever joined into a new bytes object.
+    """
+    yield b'{"seq":%d,"lines":[' % seq
+    sep = b""
+    for end in range(len(entries), 0, -LOG_STREAM_BATCH):
+        batch = reversed(entries[max(end - LOG_STREAM_BATCH, 0):end])
+        yield sep + b",".join(line for _, line in batch)
+        sep = b","
+    yield b"]}"
 
 @app.get("/logs")
-def get_logs(limit: int = 300):
-    """Returns the last `limit` log lines."""
-    return {"lines": list(LOG_DEQUE)}
+async def get_logs(limit: int = 300, since: Optional[int] = None):
+    """Returns the last `limit` log lines, or only those logged after sequence `since`."""
+    # Newest first; stop at `limit` entries so the rest of the deque is never visited
+    entries = list(islice(reversed(LOG_DEQUE), max(limit, 0)))
+    seq = _log_seq
+    if since is not None and since <= seq:
+        # Sequence numbers are consecutive, so the newest `seq - since` entries are the new ones
+        entries = entries[:seq - since]
+    # Otherwise a `since` beyond our newest entry comes from before a restart: send the full tail
+    return StreamingResponse(_stream_logs(seq, entries), media_type="application/json")
 
 class GotoCoords(BaseModel):
     x: float
@@ -123,18 +230,10 @@ class GotoCoords(BaseModel):
     z: float
 
 @app.post("/mcp/goto_target")
-def handle_goto_target(coords: GotoCoords):
+async def handle_goto_target(coords: GotoCoords):
     """API endpoint to set the target coordinates for the mocked device."""
-    # This manually implements the logic of the goto_target tool
-    # to ensure the endpoint works, bypassing the fastmcp http layer.
-    global target_location
-    target_location = {"x": coords.x, "y": coords.y, "z": coords.z}
-    # current_position = {"x": 0.0, "y": 0.0, "z": 0.0}
-    log_message = f"GOTO target set to: x={coords.x}, y={coords.y}, z={coords.z}."
-    logging.info(log_message)
-    log_line = f"{datetime.now(timezone.utc).isoformat()}Z INFO {log_message}"
-    LOG_DEQUE.append(log_line)
-    return f"GOTO target set to: x={coords.x}, y={coords.y}, z={coords.z}."
+    # Shares set_goto_target with goto_target(), bypassing the fastmcp http layer.
+    return set_goto_target(coords.x, coords.y, coords.z)
 
 # Mount the MCP server as a sub-application
 # mcp_app = MockedArduinoMCP.http_app()
@@ -144,14 +243,11 @@ def handle_goto_target(coords: GotoCoords):
 if __name__ == "__main__":
     log_message = "Starting Mocked MCP Server..."
     logging.info(log_message)
-    log_line = f"{datetime.now(timezone.utc).isoformat()}Z INFO {log_message}"
-    LOG_DEQUE.append(log_line)
-
-    # Start the data generation loop in a background thread
-    data_thread = threading.Thread(target=data_generation_loop, daemon=True)
-    data_thread.start()
+    log_line = f"{fmt_ts(time.time_ns())} INFO {log_message}"
+    append_log_line(log_line)
 
     # Run the web server
     # The MCP server is now available at http://localhost:8100/mcp
     # The logs are available at http://localhost:8100/logs
-    uvicorn.run(app, host="0.0.0.0", port=8100)
+    # "auto" selects uvloop where it is installed (it is unavailable on Windows)
+    uvicorn.run(app, host="0.0.0.0", port=8100, loop="auto", http="httptools")
@@ -0,0 +1,14 @@
+import time
+from typing import Tuple
+
+_last_ts_sec: Tuple[int, str] = (-1, "")
+
+def fmt_ts(ns: int) -> str:
+    """Formats epoch nanoseconds as ISO-8601 UTC, reusing the date/time prefix within a second."""
+    global _last_ts_sec
+    sec, rem = divmod(ns, 1_000_000_000)
+    last_sec, prefix = _last_ts_sec
+    if sec != last_sec:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+        _last_ts_sec = (sec, prefix)
+    return f"{prefix}.{rem // 1000:06d}Z"